@@ -1,21 +1,42 @@
 # audio_processor.py
 
 import asyncio
-import base64
+import functools
 import json
 import os
-import wave
+import struct
+import types
+import numpy as np
 from websockets.asyncio.client import connect
+from websockets.protocol import State
 import websockets
 import pyaudio
 from dotenv import load_dotenv
 import sys
 
+try:
+    # SIMD-accelerated decoder, falls back to the stdlib implementation
+    from pybase64 import b64decode
+except ImportError:
+    from base64 import b64decode
+
+try:
+    import orjson
+
+    def json_dumps(obj):
+        # Keep sending text frames, as the stdlib encoder did
+        return orjson.dumps(obj).decode()
+
+    json_loads = orjson.loads
+except ImportError:
+    json_dumps = json.dumps
+    json_loads = json.loads
+
 load_dotenv()
 
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
 
-LANGUAGE_CODE_MAP = {
+LANGUAGE_CODE_MAP = types.MappingProxyType({
     "german": "de-DE",
     "english (australia)": "en-AU",
     "english (uk)": "en-GB",
@@ -49,22 +70,31 @@ LANGUAGE_CODE_MAP = {
     "polish": "pl-PL",
     "russian": "ru-RU",
     "thai": "th-TH",
-}
+})
 DEFAULT_LANGUAGE_CODE = "en-US"
 
+@functools.lru_cache(maxsize=None)
+def resolve_language(language_name):
+    """Returns the BCP-47 code for a language name, case-insensitively"""
+    return LANGUAGE_CODE_MAP.get(language_name.strip().casefold(), DEFAULT_LANGUAGE_CODE)
+
+# 44-byte PCM WAV header: RIFF chunk, fmt subchunk and data subchunk header
+_WAV_HEADER = struct.Struct('<4sI4s4sIHHIIHH4sI')
+
 if sys.version_info < (3, 11):
     import taskgroup, exceptiongroup
     asyncio.TaskGroup = taskgroup.TaskGroup
     asyncio.ExceptionGroup = exceptiongroup.ExceptionGroup
 
 class AudioGenerator:
-    def __init__(self, voice, language_name="english"):
+    def __init__(self, voice, language_name="english", context=None):
         self.voice = voice
-        self.language_code = LANGUAGE_CODE_MAP.get(language_name.lower(), DEFAULT_LANGUAGE_CODE)
+        self.language_code = resolve_language(language_name)
         print(f"AudioGenerator initialized with language: {language_name}, using code: {self.language_code}")
-        self.audio_in_queue = asyncio.Queue()
         self.ws = None
-        self.ws_semaphore = asyncio.Semaphore(1)
+        # Context shared by every dialogue, sent as the system instruction of
+        # each new connection
+        self.context = context
 
         # Audio configuration
         self.FORMAT = pyaudio.paInt16
@@ -73,10 +103,15 @@ class AudioGenerator:
         self.CHUNK_SIZE = 512
 
         # WebSocket configuration
+        # Audio arrives as large base64 JSON frames that deflate barely shrinks,
+        # so skip per-message compression and allow frames of up to 16 MiB
         self.ws_options = {
             'ping_interval': 10,
             'ping_timeout': 7,
-            'close_timeout': 5
+            'close_timeout': 5,
+            'compression': None,
+            'max_size': 2**24,
+            'write_limit': 2**20
         }
 
         # API configuration
@@ -84,119 +119,195 @@ class AudioGenerator:
         self.model = "gemini-2.0-flash-live-001"
         self.uri = f"wss://{self.host}/ws/google.ai.generativelanguage.v1beta.GenerativeService.BidiGenerateContent?key={GOOGLE_API_KEY}"
 
-        self.complete_audio = bytearray()
+        self._setup_payload = self.build_setup_payload()
 
-    async def cleanup(self):
-        if self.ws:
-            await self.ws.close()
-        self.complete_audio.clear()
-        while not self.audio_in_queue.empty():
-            self.audio_in_queue.get_nowait()
-
-    async def process_batch(self, dialogues, output_files):
-        ws = await connect(self.uri, **self.ws_options)
-        async with ws:
-            self.ws = ws
-            await self.startup(ws, self.voice)
-            for dialogue, output_file in zip(dialogues, output_files):
-                await self.send_text(ws, dialogue)
-                await self.receive_audio(output_file)
-
-    async def startup(self, ws, voice):
-        async with self.ws_semaphore:
-            setup_msg = {
-                "setup": {
-                    "model": f"models/{self.model}",
-                    "generation_config": {
-                        "speech_config": {
-                            "language_code": self.language_code,
-                            "voice_config": {
-                                "prebuilt_voice_config": {
-                                    "voice_name": voice
-                                }
+        # WAV file of the current turn, written as audio frames arrive
+        self._wav_file = None
+        self._data_len = 0
+        # Reused for every frame's mono to stereo duplication
+        self._stereo_scratch = np.empty(8192, dtype='<i2')
+
+    def build_setup_payload(self):
+        """Serializes the setup message once; it is resent as-is on every
+        connection"""
+        setup_msg = {
+            "setup": {
+                "model": f"models/{self.model}",
+                "generation_config": {
+                    "speech_config": {
+                        "language_code": self.language_code,
+                        "voice_config": {
+                            "prebuilt_voice_config": {
+                                "voice_name": self.voice
                             }
                         }
                     }
                 }
             }
-            await ws.send(json.dumps(setup_msg))
-            response = await ws.recv()  # You might want to handle this response
+        }
+        if self.context is not None:
+            # Given as a system instruction the context primes the session
+            # without being synthesized
+            setup_msg["setup"]["system_instruction"] = {"parts": [{"text": self.context}]}
+        return json_dumps(setup_msg)
+
+    async def __aenter__(self):
+        # Keep one connection open for every batch processed in the block
+        await self.open_session()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.cleanup()
+
+    async def cleanup(self):
+        if self.ws:
+            await self.ws.close()
+            self.ws = None
+        if self._wav_file:
+            self._wav_file.close()
+            self._wav_file = None
+
+    async def open_session(self):
+        self.ws = await connect(self.uri, **self.ws_options)
+        await self.startup(self.ws)
+
+    async def is_connected(self):
+        if self.ws is None or self.ws.state is not State.OPEN:
+            return False
+        try:
+            pong_waiter = await self.ws.ping()
+            await asyncio.wait_for(pong_waiter, self.ws_options['ping_timeout'])
+        except (websockets.exceptions.ConnectionClosed, asyncio.TimeoutError):
+            return False
+        return True
+
+    async def process_batch(self, dialogues, output_files, on_file_saved=None):
+        if await self.is_connected():
+            await self.stream_turns(self.ws, dialogues, output_files, on_file_saved)
+            return
+
+        await self.open_session()
+        async with self.ws:
+            await self.stream_turns(self.ws, dialogues, output_files, on_file_saved)
+
+    async def stream_turns(self, ws, dialogues, output_files, on_file_saved=None):
+        """Sends each dialogue and writes its audio to the matching output
+        file; a session speaks one turn at a time, so the next dialogue is
+        only sent once the previous turn completes. on_file_saved, if given,
+        is called with each output file once written"""
+        for dialogue, output_file in zip(dialogues, output_files):
+            await self.send_text(ws, dialogue)
+            await self.receive_audio(output_file)
+            if on_file_saved:
+                on_file_saved(output_file)
+
+    async def startup(self, ws):
+        await ws.send(self._setup_payload)
+        response = await ws.recv()  # You might want to handle this response
 
     async def send_text(self, ws, text):
-        async with self.ws_semaphore:
-            msg = {
-                "client_content": {
-                    "turn_complete": True,
-                    "turns": [
-                        {"role": "user", "parts": [{"text": text}]}
-                    ]
-                }
+        msg = {
+            "client_content": {
+                "turn_complete": True,
+                "turns": [
+                    {"role": "user", "parts": [{"text": text}]}
+                ]
             }
-            await ws.send(json.dumps(msg))
+        }
+        await ws.send(json_dumps(msg))
 
     async def receive_audio(self, output_file):
-        async with self.ws_semaphore:
-            self.complete_audio.clear()
-            await asyncio.sleep(0.1)
-
-            try:
-                async for raw_response in self.ws:
-                    response = json.loads(raw_response)
-
-                    try:
-                        parts = response["serverContent"]["modelTurn"]["parts"]
-                        for part in parts:
-                            if "inlineData" in part:
-                                b64data = part["inlineData"]["data"]
-                                pcm_data = base64.b64decode(b64data)
-                                self.complete_audio.extend(pcm_data)
-                                self.audio_in_queue.put_nowait(pcm_data)
-                    except KeyError:
-                        pass
-
-                    try:
-                        if response["serverContent"].get("turnComplete", False):
-                            self.save_wav_file(output_file)
-                            while not self.audio_in_queue.empty():
-                                self.audio_in_queue.get_nowait()
-                            break
-                    except KeyError:
-                        pass
-
-            except websockets.exceptions.ConnectionClosedError as e:
-                print(f"Connection closed: {e}")
-                raise
-
-    def save_wav_file(self, filename):
-        with wave.open(filename, 'wb') as wav_file:
-            wav_file.setnchannels(self.CHANNELS)
-            wav_file.setsampwidth(2)
-            wav_file.setframerate(self.SAMPLE_RATE)
-            stereo_data = bytearray()
-            for i in range(0, len(self.complete_audio), 2):
-                sample = self.complete_audio[i:i+2]
-                # Convert mono to stereo by duplicating the sample
-                stereo_data.extend(sample)
-                stereo_data.extend(sample)
-            wav_file.writeframes(stereo_data)
+        # Calls on a connection are strictly sequential, so no locking is needed
+        # Without an output file the turn's audio is read and discarded
+        if output_file is not None:
+            self.open_wav_file(output_file)
+
+        # Bind the per-frame callables once instead of looking them up each frame
+        recv = self.ws.recv
+        loads = json_loads
+        write_frames = self.write_wav_frames if output_file is not None else None
+
+        try:
+            while True:
+                # Take frames as raw bytes: both JSON parsers accept them, which
+                # skips decoding every large base64 payload to str first
+                raw_response = await recv(decode=False)
+                response = loads(raw_response)
+
+                server_content = response.get("serverContent")
+                if not server_content:
+                    continue
+
+                model_turn = server_content.get("modelTurn")
+                if model_turn:
+                    for part in model_turn.get("parts", ()):
+                        inline_data = part.get("inlineData")
+                        if inline_data and write_frames:
+                            write_frames(b64decode(inline_data["data"]))
+
+                if server_content.get("turnComplete", False):
+                    if output_file is not None:
+                        self.close_wav_file()
+                    break
+
+        except websockets.exceptions.ConnectionClosedError as e:
+            print(f"Connection closed: {e}")
+            if self._wav_file:
+                self._wav_file.close()
+                self._wav_file = None
+            raise
+
+    def wav_header(self, data_len):
+        block_align = self.CHANNELS * 2
+        return _WAV_HEADER.pack(
+            b'RIFF', 36 + data_len, b'WAVE', b'fmt ', 16, 1, self.CHANNELS, self.SAMPLE_RATE,
+            self.SAMPLE_RATE * block_align, block_align, 16, b'data', data_len)
+
+    def open_wav_file(self, filename):
+        # Sizes are unknown until the turn completes; close_wav_file patches them
+        self._wav_file = open(filename, 'wb')
+        self._wav_file.write(self.wav_header(0))
+        self._data_len = 0
+
+    def write_wav_frames(self, pcm_data):
+        samples = np.frombuffer(pcm_data, dtype='<i2', count=len(pcm_data) // 2)
+        n = 2 * len(samples)
+        if n > len(self._stereo_scratch):
+            self._stereo_scratch = np.empty(n, dtype='<i2')
+
+        # Convert mono to stereo by duplicating every int16 sample
+        stereo = self._stereo_scratch[:n]
+        stereo[0::2] = samples
+        stereo[1::2] = samples
+        self._wav_file.write(memoryview(stereo).cast('B'))
+        self._data_len += 2 * n
+
+    def close_wav_file(self):
+        self._wav_file.seek(0)
+        self._wav_file.write(self.wav_header(self._data_len))
+        self._wav_file.close()
+        self._wav_file = None
 
     async def run(self, dialogues, output_files, max_retries=3):
+        # Reuse the session connection when there is one; only reconnect
+        # after it has actually been dropped
+        owns_connection = not await self.is_connected()
         last_exception = None
-        for attempt in range(max_retries):
-            try:
-                ws = await connect(self.uri, **self.ws_options)
-                async with ws:
-                    self.ws = ws
-                    await self.startup(self.ws, self.voice)
-                    for dialogue, output_file in zip(dialogues, output_files):
-                        await self.send_text(self.ws, dialogue)
-                        await self.receive_audio(output_file)
-                return
-            except websockets.exceptions.ConnectionClosedError as e:
-                last_exception = e
-                if attempt < max_retries - 1:
-                    print(f"Connection lost. Retrying in 5 seconds... (Attempt {attempt + 1}/{max_retries})")
-                    await asyncio.sleep(5)
-                else:
-                    print("Max retries reached. Unable to reconnect.")
-                    raise last_exception
+        try:
+            for attempt in range(max_retries):
+                try:
+                    if attempt or owns_connection:
+                        await self.open_session()
+                    await self.stream_turns(self.ws, dialogues, output_files)
+                    return
+                except websockets.exceptions.ConnectionClosedError as e:
+                    last_exception = e
+                    if attempt < max_retries - 1:
+                        print(f"Connection lost. Retrying in 5 seconds... (Attempt {attempt + 1}/{max_retries})")
+                        await asyncio.sleep(5)
+                    else:
+                        print("Max retries reached. Unable to reconnect.")
+                        raise last_exception
+        finally:
+            if owns_connection:
+                await self.cleanup()
@@ -0,0 +1,71 @@
+# content_cache.py
+
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import zlib
+
+class ContentCache:
+    """Store of text extracted from sources or generated from them: one
+    zlib-compressed text per key plus a JSON sidecar with its metadata (e.g.
+    the ETag of a URL)"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def file_key(source_type, path):
+        """Key of a local file; changes whenever the file is modified. Raises
+        OSError if the file cannot be stat'ed"""
+        stat = os.stat(path)
+        source = f"{source_type}:{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}"
+        return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def url_key(url):
+        """Key of a URL; freshness is checked against the stored ETag"""
+        return hashlib.sha256(f"url:{url}".encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def script_key(*inputs):
+        """Key of a generated script, from everything that went into it"""
+        return hashlib.sha256("\0".join(map(str, inputs)).encode('utf-8')).hexdigest()
+
+    def _path(self, key, extension):
+        return os.path.join(self.cache_dir, f"{key}.{extension}")
+
+    def get(self, key):
+        """Returns (text, metadata) for key, or None on a miss"""
+        try:
+            with open(self._path(key, 'json'), 'r', encoding='utf-8') as file:
+                metadata = json.load(file)
+            with open(self._path(key, 'txt.z'), 'rb') as file:
+                text = zlib.decompress(file.read()).decode('utf-8')
+        except (OSError, ValueError, zlib.error):
+            return None
+        return text, metadata
+
+    def put(self, key, text, **metadata):
+        """Stores text under key; each file only becomes visible once fully
+        written, text first so a sidecar never points at a missing entry.
+        A failed write is reported and leaves the entry uncached"""
+        for extension, data in (('txt.z', zlib.compress(text.encode('utf-8'))),
+                                ('json', json.dumps(metadata).encode('utf-8'))):
+            # A unique temp file per write, as threads may store the same key
+            try:
+                fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            except OSError as e:
+                print(f"Could not cache {key}: {e}")
+                return
+            try:
+                with os.fdopen(fd, 'wb') as file:
+                    file.write(data)
+                os.replace(tmp_path, self._path(key, extension))
+            except OSError as e:
+                print(f"Could not cache {key}: {e}")
+                with contextlib.suppress(OSError):
+                    os.remove(tmp_path)
+                return
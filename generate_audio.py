@@ -2,12 +2,29 @@
 
 import tempfile
 import asyncio
+import contextlib
 import os
-from audio_processor import AudioGenerator
+from audio_processor import AudioGenerator, resolve_language
+from tts_cache import TtsCache
 from dotenv import load_dotenv
-from pydub import AudioSegment
+import numpy as np
 import argparse
-import re
+import mmap
+import queue
+import wave
+from itertools import chain
+
+try:
+    # libuv-backed event loop, not available on Windows
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    # SIMD resampler for inputs whose rate differs from the output
+    import soxr
+except ImportError:
+    soxr = None
 
 load_dotenv()
 
@@ -15,29 +32,41 @@ VOICE_A = os.getenv('VOICE_A', 'Puck')
 VOICE_B = os.getenv('VOICE_B', 'Kore')
 VOICE_C = os.getenv('VOICE_C', 'Charon')
 
-def parse_audio_args():
+# Length of the fade applied at both ends of every clip: 2 ms at 24 kHz is
+# enough to remove the click of a DC/phase jump without audible effect
+FADE_FRAMES = 48
+
+# Write buffer of the combined output file
+COMBINE_BUFFER_SIZE = 1 << 20
+
+# Free space /dev/shm needs before the per-line files are placed there
+TMPFS_MIN_FREE = 512 << 20
+
+# Upper bound on websockets open at the same time across all speakers, to
+# stay within the API's concurrent session quota
+TTS_CONCURRENCY = max(1, int(os.getenv('TTS_CONCURRENCY', '3')))
+
+# Websockets each speaker splits its lines across; every extra connection
+# costs one more session set up with the full script as its context
+TTS_SPEAKER_CONNECTIONS = max(1, int(os.getenv('TTS_SPEAKER_CONNECTIONS', '1')))
+
+def parse_audio_args(argv=None):
     parser = argparse.ArgumentParser(description="Generate audio from script.")
     parser.add_argument('--language', default='English', help='Language for audio narration')
-    return parser.parse_args()
+    parser.add_argument('--tts-cache-dir', help='Directory to reuse synthesized lines from across runs')
+    parser.add_argument('--concurrency', type=int, default=TTS_CONCURRENCY,
+                        help='Max Live API connections open at once (default: TTS_CONCURRENCY or 3)')
+    return parser.parse_args(argv)
 
-def parse_conversation(file_path):
-    with open(file_path, 'r', encoding='utf-8') as file:
-        content = file.read()
-
-    lines = content.strip().split('\n')
-    speaker_a_lines = []
-    speaker_b_lines = []
-    speaker_c_lines = []
-    for index, line in enumerate(lines, start=0):
-        if line.strip():
-            if line.startswith("Speaker A:"):
-                speaker_a_lines.append(line.replace("Speaker A:", f"{index}|").strip())
-            elif line.startswith("Speaker B:"):
-                speaker_b_lines.append(line.replace("Speaker B:", f"{index}|").strip())
-            elif line.startswith("Speaker C:"):
-                speaker_c_lines.append(line.replace("Speaker C:", f"{index}|").strip())
-
-    return speaker_a_lines, speaker_b_lines, speaker_c_lines
+def parse_conversation(content):
+    speaker_lines = {"Speaker A": [], "Speaker B": [], "Speaker C": []}
+    for index, line in enumerate(content.splitlines()):
+        speaker, _, dialogue = line.partition(":")
+        bucket = speaker_lines.get(speaker)
+        if bucket is not None:
+            bucket.append(f"{index}|{dialogue.strip()}")
+
+    return speaker_lines["Speaker A"], speaker_lines["Speaker B"], speaker_lines["Speaker C"]
 
 def read_file_content(file_path):
     with open(file_path, 'r', encoding='utf-8') as file:
@@ -47,100 +76,314 @@ async def setup_environment():
     script_dir = os.path.dirname(os.path.abspath(__file__))
     return script_dir
 
-def read_and_parse_inputs():
-    system_instructions = read_file_content('system_instructions_audio.txt')
+def temp_root(script_dir):
+    """Returns where to create the per-line files: PODCAST_TMPDIR if set, else
+    /dev/shm when writable with enough room, else the script directory"""
+    tmp_dir = os.getenv('PODCAST_TMPDIR')
+    if tmp_dir:
+        return tmp_dir
+    try:
+        shm = os.statvfs('/dev/shm')
+    except (AttributeError, OSError):
+        # No statvfs on Windows, no /dev/shm on macOS
+        return script_dir
+    if os.access('/dev/shm', os.W_OK) and shm.f_bavail * shm.f_frsize >= TMPFS_MIN_FREE:
+        return '/dev/shm'
+    return script_dir
+
+def read_and_parse_inputs(system_instructions=None, language='English'):
+    # Instructions passed in memory take precedence; otherwise they are
+    # rendered from the template for this run's language, so a standalone
+    # run never picks up a stale system_instructions_audio.txt
+    if system_instructions is None:
+        template = read_file_content('system_instructions_audio_template.txt')
+        system_instructions = template.replace('[LANGUAGE]', language)
     full_script = read_file_content('podcast_script.txt')
-    speaker_a_lines, speaker_b_lines, speaker_c_lines = parse_conversation('podcast_script.txt')
+    speaker_a_lines, speaker_b_lines, speaker_c_lines = parse_conversation(full_script)
     return system_instructions, full_script, speaker_a_lines, speaker_b_lines, speaker_c_lines
 
-def prepare_speaker_dialogues(system_instructions, full_script, speaker_lines, voice, temp_dir):
-    dialogues = [system_instructions + "\n\n" + full_script]
-    output_files = [os.path.join(temp_dir, f"speaker_{voice}_initial.wav")]
+def prepare_speaker_dialogues(speaker_lines, voice, temp_dir):
+    """Returns the dialogues to send, their output files and the
+    (line number, output file) pairs of the spoken lines"""
+    parsed_lines = [get_line_number(line) for line in speaker_lines]
+    prefix = temp_dir + os.sep
+    suffix = f"_speaker_{voice}.wav"
 
-    for i, line in enumerate(speaker_lines):
-        line_num, line_dialog = get_line_number(line)
-        dialogues.append(line_dialog)
-        output_files.append(os.path.join(temp_dir, f"{line_num}_speaker_{voice}.wav"))
+    dialogues = [line_dialog for _, line_dialog in parsed_lines]
+    numbered_files = [(line_num, f"{prefix}{line_num}{suffix}") for line_num, _ in parsed_lines]
+    output_files = [output_file for _, output_file in numbered_files]
 
-    return dialogues, output_files
+    return dialogues, output_files, numbered_files
 
 def get_line_number(line):
-    match = re.match(r"(\d+)\|(.*)", line)
-    if match:
-        return int(match.group(1)), match.group(2).strip()
+    line_num, sep, dialogue = line.partition("|")
+    if sep and line_num.isdecimal():
+        return int(line_num), dialogue.strip()
     return None, line
 
-async def process_speaker(voice, dialogues, output_files, language_name="english"):
-    # Create a single generator for all dialogues
-    generator = AudioGenerator(voice, language_name=language_name)
-    
-    # Process the entire batch of dialogues at once
-    await generator.process_batch(dialogues, output_files)
-
-    # Ensure the websocket connection is closed
-    if generator.ws:
-        await generator.ws.close()
-        
-def extract_line_num(filename):
-    match = re.search(r"(\d+)_speaker_.*\.wav", filename)
-    if match:
-        return int(match.group(1))
-    return float('inf')
+async def gather_or_cancel(*coros):
+    """Runs coros concurrently like asyncio.gather, but cancels and awaits the
+    rest as soon as one fails so no websocket is left open behind it"""
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+async def process_speaker(voice, context, dialogues, output_files, language_name="english",
+                          on_file_saved=None, connections=1, semaphore=None):
+    """Synthesizes a speaker's dialogues over up to `connections` websockets,
+    each taking every n-th dialogue; semaphore, if given, is held for as long
+    as each connection is open"""
+    # A speaker without lines (e.g. Speaker C in a two-host script) needs no
+    # session at all
+    if not dialogues:
+        return
+    connections = max(1, min(connections, len(dialogues)))
+
+    async def run_connection(index):
+        async with semaphore or contextlib.nullcontext():
+            # One generator per connection, primed with the instructions and
+            # full script as its system instruction (on any reconnect too);
+            # the session closes the websocket connection on exit
+            async with AudioGenerator(voice, language_name=language_name, context=context) as generator:
+                await generator.process_batch(dialogues[index::connections], output_files[index::connections],
+                                              on_file_saved=on_file_saved)
+
+    await gather_or_cancel(*(run_connection(index) for index in range(connections)))
+
+
+def restore_cached_lines(cache, keys, dialogues, output_files, on_file_saved):
+    """Copies every line found in the cache to its output file, reporting it
+    through on_file_saved, and returns the dialogues and output files that
+    still have to be synthesized"""
+    pending_dialogues, pending_files = [], []
+    for dialogue, output_file in zip(dialogues, output_files):
+        if cache.fetch(keys[output_file], output_file):
+            on_file_saved(output_file)
+        else:
+            pending_dialogues.append(dialogue)
+            pending_files.append(output_file)
+    return pending_dialogues, pending_files
 
 def interleave_output_files(speaker_a_files, speaker_b_files, speaker_c_files):
-    """Interleaves the audio files from all speakers to maintain conversation order"""
-    all_files = speaker_a_files + speaker_b_files + speaker_c_files
-    all_files.sort(key=extract_line_num)
-    return all_files
+    """Interleaves the (line number, file) pairs from all speakers to maintain
+    conversation order and returns the ordered files"""
+    # Line numbers are unique script line indices, so each file can be placed
+    # at its own slot instead of sorting
+    all_files = list(chain(speaker_a_files, speaker_b_files, speaker_c_files))
+    by_line = [None] * (max((line_num for line_num, _ in all_files), default=-1) + 1)
+    for line_num, file in all_files:
+        by_line[line_num] = file
+    return [file for file in by_line if file is not None]
+
+def iter_saved_in_order(saved_files, file_list):
+    """Yields file_list in order, blocking until each file has been reported on
+    the saved_files queue; a None on the queue aborts the iteration"""
+    ready = set()
+    for file in file_list:
+        while file not in ready:
+            saved = saved_files.get()
+            if saved is None:
+                raise RuntimeError("Audio generation stopped before all files were saved")
+            ready.add(saved)
+        yield file
+
+def write_pcm_frames(combined, frames, sample_width):
+    """Writes stereo frames to the output, fading 16-bit audio in and out over
+    FADE_FRAMES frames; only the faded edges are copied"""
+    if sample_width != 2:
+        combined.writeframesraw(frames)
+        return
+
+    samples = np.frombuffer(frames, dtype='<i2').reshape(-1, 2)
+    n = min(FADE_FRAMES, len(samples) // 2)
+    if n == 0:
+        combined.writeframesraw(frames)
+        return
+
+    ramp = np.linspace(0.0, 1.0, n, dtype=np.float32)[:, None]
+    head = (samples[:n] * ramp).astype('<i2').tobytes()
+    tail = (samples[-n:] * ramp[::-1]).astype('<i2').tobytes()
+    del samples
+    combined.writeframesraw(head)
+    with memoryview(frames) as view:
+        combined.writeframesraw(view[len(head):len(view) - len(tail)])
+    combined.writeframesraw(tail)
+
+def resample_pcm(frames, in_rate, out_rate):
+    """Resamples 16-bit stereo frames from in_rate to out_rate, with soxr when
+    installed and linear interpolation otherwise"""
+    samples = np.frombuffer(frames, dtype='<i2').reshape(-1, 2)
+    if soxr is not None:
+        return soxr.resample(samples, in_rate, out_rate).astype('<i2', copy=False).tobytes()
+
+    positions = np.arange(len(samples) * out_rate // in_rate) * (in_rate / out_rate)
+    resampled = np.empty((len(positions), 2), dtype='<i2')
+    for channel in range(2):
+        resampled[:, channel] = np.interp(positions, np.arange(len(samples)), samples[:, channel])
+    return resampled.tobytes()
+
+def copy_pcm_frames(file, data_len, sample_width, combined):
+    """Copies the PCM data of a canonical 44-byte-header WAV straight from a
+    memory map into the output; returns False for any other layout"""
+    with open(file, 'rb') as raw, mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        if mapped[36:40] != b'data':
+            return False
+        with memoryview(mapped) as view:
+            write_pcm_frames(combined, view[44:44 + data_len], sample_width)
+    return True
 
 def combine_audio_files(file_list, output_file, silence_duration_ms=50):
-    combined = AudioSegment.empty()
-    silence = AudioSegment.silent(duration=silence_duration_ms)
+    """Appends the PCM frames of every WAV in file_list to a stereo output file,
+    streaming file by file instead of building the whole podcast in memory"""
+    # Large write buffer so the many small edge, silence and header writes
+    # are batched into few system calls
+    with open(output_file, 'wb', buffering=COMBINE_BUFFER_SIZE) as output, wave.open(output, 'wb') as combined:
+        # Defaults for an empty file_list; the first input overrides them
+        combined.setnchannels(2)
+        combined.setsampwidth(2)
+        combined.setframerate(24000)
+        silence = None
 
-    for file in file_list:
-        audio = AudioSegment.from_wav(file)
-        if audio.channels == 1:
-            audio = audio.set_channels(2)
-        combined += audio + silence
+        for file in file_list:
+            with wave.open(file, 'rb') as audio:
+                sample_width = audio.getsampwidth()
+                frame_rate = audio.getframerate()
+                if silence is None:
+                    combined.setsampwidth(sample_width)
+                    combined.setframerate(frame_rate)
+                    output_rate = frame_rate
+                    silence = b"\x00" * (silence_duration_ms * frame_rate // 1000 * 2 * sample_width)
+                # Only 16-bit audio is resampled; the Live API never sends anything else
+                resample = frame_rate != output_rate and sample_width == 2
+                channels = audio.getnchannels()
+                data_len = audio.getnframes() * channels * sample_width
+                if channels == 2 and not resample and copy_pcm_frames(file, data_len, sample_width, combined):
+                    frames = None
+                else:
+                    frames = audio.readframes(audio.getnframes())
+                if channels == 1:
+                    # Duplicate each sample (sample_width bytes) into both channels
+                    samples = np.frombuffer(frames, dtype=np.uint8).reshape(-1, sample_width)
+                    frames = np.repeat(samples, 2, axis=0).tobytes()
+                if resample:
+                    frames = resample_pcm(frames, frame_rate, output_rate)
 
-    combined.export(output_file, format="wav")
+            if frames is not None:
+                write_pcm_frames(combined, frames, sample_width)
+            combined.writeframesraw(silence)
 
-async def main():
-    audio_args = parse_audio_args()
+async def main(argv=None, audio_instructions=None):
+    audio_args = parse_audio_args(argv)
     language = audio_args.language
 
     script_dir = await setup_environment()
 
-    with tempfile.TemporaryDirectory(dir=script_dir) as temp_dir:
-        system_instructions, full_script, speaker_a_lines, speaker_b_lines, speaker_c_lines = read_and_parse_inputs()
-
-        # Prepare dialogues for both speakers
-        dialogues_a, output_files_a = prepare_speaker_dialogues(
-            system_instructions, full_script, speaker_a_lines, VOICE_A, temp_dir)
-        dialogues_b, output_files_b = prepare_speaker_dialogues(
-            system_instructions, full_script, speaker_b_lines, VOICE_B, temp_dir)
-        dialogues_c, output_files_c = prepare_speaker_dialogues(
-            system_instructions, full_script, speaker_c_lines, VOICE_C, temp_dir)
-
-        # Process Speaker A first
-        print("Processing Speaker A...")
-        await process_speaker(VOICE_A, dialogues_a, output_files_a, language_name=language)
-        
-        # Then process Speaker B
-        print("Processing Speaker B...")
-        await process_speaker(VOICE_B, dialogues_b, output_files_b, language_name=language)
-        
-        # Then process Speaker C
-        print("Processing Speaker C...")
-        await process_speaker(VOICE_C, dialogues_c, output_files_c, language_name=language)
-
-        # Interleave and combine audio as before
-        all_output_files = interleave_output_files(output_files_a[1:], output_files_b[1:], output_files_c[1:])
+    # Memory-backed when possible, so the small per-line files never hit disk
+    with tempfile.TemporaryDirectory(dir=temp_root(script_dir)) as temp_dir:
+        # Keep blocking file I/O off the event loop
+        system_instructions, full_script, speaker_a_lines, speaker_b_lines, speaker_c_lines = \
+            await asyncio.to_thread(read_and_parse_inputs, audio_instructions, language)
+
+        # Context every speaker receives once before its own lines
+        context = system_instructions + "\n\n" + full_script
+
+        # Prepare dialogues for all speakers
+        dialogues_a, output_files_a, numbered_files_a = prepare_speaker_dialogues(
+            speaker_a_lines, VOICE_A, temp_dir)
+        dialogues_b, output_files_b, numbered_files_b = prepare_speaker_dialogues(
+            speaker_b_lines, VOICE_B, temp_dir)
+        dialogues_c, output_files_c, numbered_files_c = prepare_speaker_dialogues(
+            speaker_c_lines, VOICE_C, temp_dir)
+
+        # Built before the combining thread starts, so a bad cache directory
+        # fails the run instead of leaving that thread waiting forever
+        tts_cache = TtsCache(audio_args.tts_cache_dir) if audio_args.tts_cache_dir else None
+        language_code = resolve_language(language)
+
+        # Combine in a worker thread while synthesis is still running: each
+        # turn is appended as soon as it and every turn before it are saved
+        all_output_files = interleave_output_files(numbered_files_a, numbered_files_b, numbered_files_c)
         final_output = "final_podcast.wav"
-        combine_audio_files(all_output_files, final_output, silence_duration_ms=50)
+        # Combined next to the output and only moved over it once every turn
+        # is in, so a failed run leaves an earlier podcast untouched
+        partial_output = f"{final_output}.partial"
+        saved_files = queue.Queue()
+        combine_task = asyncio.ensure_future(asyncio.to_thread(
+            combine_audio_files, iter_saved_in_order(saved_files, all_output_files),
+            partial_output, silence_duration_ms=50))
+
+        # Each connection has its own generator and websocket, so speakers (and
+        # the connections within a speaker) are independent and can be
+        # synthesized concurrently
+        semaphore = asyncio.Semaphore(max(1, audio_args.concurrency))
+
+        # Cache copies run in worker threads; they are awaited before the temp
+        # dir holding their source files is removed
+        cache_writes = []
+
+        def cache_line(key, output_file, voice):
+            # A line that cannot be cached is only synthesized again next run
+            try:
+                tts_cache.put(key, output_file, voice=voice, language=language_code)
+            except OSError as e:
+                print(f"Could not cache {output_file}: {e}")
+
+        async def run_speaker(name, voice, dialogues, output_files):
+            on_file_saved = saved_files.put
+            if tts_cache is not None:
+                keys = {output_file: TtsCache.make_key(voice, language_code, dialogue, system_instructions)
+                        for dialogue, output_file in zip(dialogues, output_files)}
+                dialogues, output_files = await asyncio.to_thread(
+                    restore_cached_lines, tts_cache, keys, dialogues, output_files, saved_files.put)
+                if not dialogues:
+                    print(f"Speaker {name}: all lines found in the TTS cache")
+                    return
+
+                def on_file_saved(output_file):
+                    saved_files.put(output_file)
+                    cache_writes.append(asyncio.ensure_future(asyncio.to_thread(
+                        cache_line, keys[output_file], output_file, voice)))
+
+            print(f"Processing Speaker {name}...")
+            await process_speaker(voice, context, dialogues, output_files, language_name=language,
+                                  on_file_saved=on_file_saved, connections=TTS_SPEAKER_CONNECTIONS,
+                                  semaphore=semaphore)
+
+        try:
+            try:
+                await gather_or_cancel(
+                    run_speaker("A", VOICE_A, dialogues_a, output_files_a),
+                    run_speaker("B", VOICE_B, dialogues_b, output_files_b),
+                    run_speaker("C", VOICE_C, dialogues_c, output_files_c))
+            except BaseException:
+                # Unblock the combining thread before the temp dir is removed
+                saved_files.put(None)
+                await asyncio.gather(combine_task, *cache_writes, return_exceptions=True)
+                raise
+
+            await asyncio.gather(combine_task, *cache_writes)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(partial_output)
+            raise
+
+        os.replace(partial_output, final_output)
         print(f"\nFinal podcast audio created: {final_output}")
 
     print("Temporary files cleaned up")
 
+def run(argv=None, audio_instructions=None):
+    """Runs main to completion on uvloop when available; audio_instructions,
+    if given, replace rendering the audio instructions template"""
+    if uvloop is not None:
+        uvloop.run(main(argv, audio_instructions))
+    else:
+        asyncio.run(main(argv, audio_instructions))
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    run()
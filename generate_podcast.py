@@ -1,3 +1,4 @@
+import functools
 import subprocess
 import os
 import logging
@@ -15,35 +16,57 @@ handler = logging.StreamHandler()
 handler.setFormatter(CustomFormatter())
 logger.addHandler(handler)
 logger.setLevel(logging.INFO)
+# Keep messages off the root logger, where generate_script installs the absl
+# handler once it is imported in-process
+logger.propagate = False
 # Remove default handlers
 logging.getLogger().handlers = []
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Generate podcast with language option.")
     parser.add_argument('--language', default='English', help='Language for audio narration')
+    parser.add_argument('--subprocess', action='store_true',
+                        help='Run the script and audio steps in separate Python processes')
     return parser.parse_args()
 
-def update_language_in_template(language):
-    template_file = 'system_instructions_audio_template.txt'
-    output_file = 'system_instructions_audio.txt'
-    
-    with open(template_file, 'r', encoding='utf-8') as file:
+@functools.lru_cache(maxsize=8)
+def render_audio_instructions(language):
+    """Returns the audio instructions template with the language filled in"""
+    with open('system_instructions_audio_template.txt', 'r', encoding='utf-8') as file:
         content = file.read()
-    
-    updated_content = content.replace('[LANGUAGE]', language)
-    
-    with open(output_file, 'w', encoding='utf-8') as file:
-        file.write(updated_content)
+    return content.replace('[LANGUAGE]', language)
 
-def generate_podcast(language):
+def run_step(module_name, language, use_subprocess):
+    """Runs generate_script.py or generate_audio.py, in this process unless
+    use_subprocess is set"""
+    argv = ["--language", language]
+    if use_subprocess:
+        subprocess.run([sys.executable, f"{module_name}.py", *argv], check=True)
+    elif module_name == "generate_script":
+        # Imported on first use so --subprocess runs never load these modules
+        import generate_script
+        generate_script.main(argv)
+    else:
+        import generate_audio
+        generate_audio.run(argv, audio_instructions=render_audio_instructions(language))
+
+def podcast_written(output_file):
+    """Whether output_file exists and is not empty, with a single stat call"""
+    try:
+        return os.stat(output_file).st_size > 0
+    except FileNotFoundError:
+        return False
+
+def generate_podcast(language, use_subprocess=False):
     try:
-        # Update language in template file
-        update_language_in_template(language)
-        logger.info(f"Updated template for language: {language}")
+        # Render the audio instructions up front so a missing template fails
+        # early; a separate generate_audio.py process renders them itself
+        render_audio_instructions(language)
+        logger.info("Rendered audio instructions for language: %s", language)
 
         # Step 1: Generate script
         logger.info("Generating podcast script...")
-        subprocess.run([sys.executable, "generate_script.py", "--language", language], check=True)
+        run_step("generate_script", language, use_subprocess)
         
         # Pause for user acknowledgment
         user_input = input("Script generated at podcast_script.txt. Press Enter to proceed to audio generation or 'q' to quit: ")
@@ -51,20 +74,20 @@ def generate_podcast(language):
             logger.info("Process terminated by user.")
             return
 
-        # Step 2: Generate audio with updated language file
+        # Step 2: Generate audio in the selected language
         logger.info("Converting script to audio...")
-        subprocess.run([sys.executable, "generate_audio.py", "--language", language], check=True)
+        run_step("generate_audio", language, use_subprocess)
         
-        if os.path.exists("final_podcast.wav"):
+        if podcast_written("final_podcast.wav"):
             logger.info("Podcast generation complete! Output: final_podcast.wav")
         else:
             logger.error("Failed to generate final podcast audio")
             
     except subprocess.CalledProcessError as e:
-        logger.error(f"Process failed: {str(e)}")
+        logger.error("Process failed: %s", e)
     except Exception as e:
-        logger.error(f"Unexpected error: {str(e)}")
+        logger.error("Unexpected error: %s", e)
 
 if __name__ == "__main__":
     args = parse_arguments()
-    generate_podcast(args.language)
+    generate_podcast(args.language, use_subprocess=args.subprocess)
@@ -1,7 +1,13 @@
+import contextlib
+import functools
+import mmap
+import multiprocessing
 import os
 import re
+import threading
 from dotenv import load_dotenv
 import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 load_dotenv()
 
@@ -16,21 +22,133 @@ absl.logging.use_absl_handler()
 
 # === Import other modules after setting environment variables ===
 import google.generativeai as genai
-import PyPDF2
+try:
+    # Native PDFium bindings, many times faster than the pure-Python readers
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+try:
+    # Maintained successor of PyPDF2 with faster text extraction
+    import pypdf
+except ImportError:
+    import PyPDF2 as pypdf
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
+from content_cache import ContentCache
+
+try:
+    # C parser, several times faster than the pure-Python html.parser
+    import lxml
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+# Elements of a web page that carry no article text
+BOILERPLATE_TAGS = ['script', 'style', 'nav', 'footer', 'header', 'aside', 'noscript', 'iframe']
+
+# Three or more line breaks in extracted web text
+BLANK_LINES_PATTERN = re.compile(r"\n{3,}")
+
+# Start of the podcast text: the first line spoken by a speaker
+PODCAST_START_PATTERN = re.compile(r"^(Speaker A:|Speaker B:|Speaker C:)", re.MULTILINE)
+
+# Gemini model that writes the podcast script
+SCRIPT_MODEL = 'gemini-2.5-flash-preview-04-17'
+
+# Text sources at least this large are read through a memory map
+MMAP_MIN_SIZE = 1 << 20
+
+# PDF text beyond this many characters (roughly 750k tokens, within the
+# model's input window) is dropped instead of being extracted
+MAX_PDF_CHARS = 3_000_000
+
+# Read buffer for pypdf, which seeks and reads the file in many small pieces
+PDF_READ_BUFFER = 1 << 20
+
+# Pages per worker process below which pypdf extraction stays serial
+PARALLEL_PDF_MIN_PAGES = 16
+
+# Sources read at the same time
+SOURCE_WORKERS = 4
+
+# PDFium is not thread-safe, so PDF sources read on different threads take
+# turns using it
+PDFIUM_LOCK = threading.Lock()
+
+# Concurrent generation requests when a long content is split into parts
+MAX_PARALLEL_PARTS = 5
+
+# Where a long content may be cut into parts, coarsest first: after a blank
+# line, after a line break, after the end of a sentence
+SPLIT_BOUNDARIES = (re.compile(r"(?<=\n\n)"), re.compile(r"(?<=\n)"), re.compile(r"(?<=[.!?]\s)"))
+
+# Shared session so repeated URLs to the same host reuse the connection;
+# transient gateway errors and dropped connections are retried with backoff
+HTTP_SESSION = requests.Session()
+HTTP_ADAPTER = HTTPAdapter(pool_maxsize=SOURCE_WORKERS,
+                           max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]))
+HTTP_SESSION.mount('http://', HTTP_ADAPTER)
+HTTP_SESSION.mount('https://', HTTP_ADAPTER)
 
 # === Rest of your code ===
+def iter_pdf_pages_pdfium(pdf_path):
+    """Yields the text of each page, closing every page as soon as its text
+    is out to free native memory"""
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        for page in pdf:
+            textpage = page.get_textpage()
+            try:
+                yield textpage.get_text_bounded()
+            finally:
+                textpage.close()
+                page.close()
+    finally:
+        pdf.close()
+
+def iter_pdf_pages_pypdf(pdf_path, start, stop):
+    with open(pdf_path, 'rb', buffering=PDF_READ_BUFFER) as file:
+        reader = pypdf.PdfReader(file)
+        for i in range(start, stop):
+            yield reader.pages[i].extract_text() or ""
+
+def extract_pdf_pages(pdf_path, start, stop):
+    return "".join(iter_pdf_pages_pypdf(pdf_path, start, stop))
+
+def join_pdf_pages(pages):
+    """Joins page texts up to MAX_PDF_CHARS; when pages are read lazily, the
+    ones past the cap are never extracted"""
+    parts, size = [], 0
+    for text in pages:
+        parts.append(text)
+        size += len(text)
+        if size >= MAX_PDF_CHARS:
+            print(f"PDF text truncated to {MAX_PDF_CHARS} characters")
+            return "".join(parts)[:MAX_PDF_CHARS]
+    return "".join(parts)
+
 def read_pdf(pdf_path):
     try:
-        with open(pdf_path, 'rb') as file:
-            reader = PyPDF2.PdfReader(file)
-            text = ""
-            for page in reader.pages:
-                extracted = page.extract_text()
-                if extracted:
-                    text += extracted
-        return text
+        if pdfium is not None:
+            # Close the document inside the lock even when the text is capped
+            # before the last page
+            with PDFIUM_LOCK, contextlib.closing(iter_pdf_pages_pdfium(pdf_path)) as pages:
+                return join_pdf_pages(pages)
+        with open(pdf_path, 'rb', buffering=PDF_READ_BUFFER) as file:
+            page_count = len(pypdf.PdfReader(file).pages)
+        workers = min(os.cpu_count() or 1, page_count // PARALLEL_PDF_MIN_PAGES)
+        if workers < 2:
+            return join_pdf_pages(iter_pdf_pages_pypdf(pdf_path, 0, page_count))
+
+        # The pure-Python parser holds the GIL, so split the pages into one
+        # contiguous range per worker process. Every range is extracted, even
+        # past the cap. Workers are spawned rather than forked, as this runs
+        # on a source thread while others may hold locks a fork would copy
+        bounds = [page_count * i // workers for i in range(workers + 1)]
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            return join_pdf_pages(executor.map(extract_pdf_pages, [pdf_path] * workers, bounds[:-1], bounds[1:]))
     except FileNotFoundError:
         print(f"Error: PDF file not found at path: {pdf_path}")
         return ""
@@ -38,10 +156,23 @@ def read_pdf(pdf_path):
         print(f"Error reading PDF file: {str(e)}")
         return ""
 
+def read_text_file(path):
+    """Reads a UTF-8 file; large files are decoded straight from a memory map
+    instead of through an intermediate bytes copy"""
+    if os.path.getsize(path) < MMAP_MIN_SIZE:
+        with open(path, 'r', encoding='utf-8') as file:
+            return file.read()
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        text = str(mapped, 'utf-8')
+    # Translate newlines like the text mode read above, so the same content
+    # gives the same text whatever its size
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text
+
 def read_md(md_path):
     try:
-        with open(md_path, 'r', encoding='utf-8') as file:
-            return file.read()
+        return read_text_file(md_path)
     except FileNotFoundError:
         print(f"Error: Markdown file not found at path: {md_path}")
         return ""
@@ -49,12 +180,32 @@ def read_md(md_path):
         print(f"Error reading Markdown file: {str(e)}")
         return ""
 
-def read_url(url):
+def read_url(url, cache=None):
     try:
-        response = requests.get(url, timeout=10)
+        # Revalidate a cached page with its ETag instead of downloading it again
+        key = ContentCache.url_key(url) if cache else None
+        cached = cache.get(key) if cache else None
+        headers = {"If-None-Match": cached[1]["etag"]} if cached and cached[1].get("etag") else None
+        # Fail fast on unreachable hosts, allow slow pages to finish
+        response = HTTP_SESSION.get(url, timeout=(3, 10), headers=headers)
+        if cached and response.status_code == 304:
+            return cached[0]
         response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'html.parser')
-        return soup.get_text()
+        # Raw bytes let the parser pick up the encoding declared in the page
+        soup = BeautifulSoup(response.content, HTML_PARSER)
+        # Drop page chrome and non-text elements, and keep to the main
+        # content when the page marks it
+        for tag in soup(BOILERPLATE_TAGS):
+            tag.decompose()
+        root = soup.find('main') or soup.find('article') or soup.body or soup
+        # One line per text node, skipping whitespace-only ones, so paragraph
+        # and heading breaks survive; runs of blank lines inside a node are
+        # collapsed
+        text = BLANK_LINES_PATTERN.sub('\n\n', root.get_text('\n', strip=True))
+        etag = response.headers.get("ETag")
+        if cache and etag and text:
+            cache.put(key, text, etag=etag)
+        return text
     except requests.exceptions.RequestException as e:
         print(f"Error accessing URL: {str(e)}")
         return ""
@@ -64,8 +215,7 @@ def read_url(url):
 
 def read_txt(txt_path):
     try:
-        with open(txt_path, 'r', encoding='utf-8') as file:
-            return file.read()
+        return read_text_file(txt_path)
     except FileNotFoundError:
         print(f"Error: Text file not found at path: {txt_path}")
         return ""
@@ -73,41 +223,65 @@ def read_txt(txt_path):
         print(f"Error reading text file: {str(e)}")
         return ""
 
-def get_content_from_sources():
-    sources = []
-    content = ""
-    
-    while True:
-        source_type = input("Enter source type (pdf/url/txt/md) or 'done' to finish: ").lower().strip()
-        
-        if source_type == 'done':
-            break
-            
-        if source_type == "pdf":
-            pdf_path = input("Enter PDF file path: ").strip()
-            pdf_content = read_pdf(pdf_path)
-            if pdf_content:
-                content += pdf_content + "\n"
-        elif source_type == "url":
-            url = input("Enter URL: ").strip()
-            url_content = read_url(url)
-            if url_content:
-                content += url_content + "\n"
-        elif source_type == "md":
-            md_path = input("Enter Markdown file path: ").strip()
-            md_content = read_md(md_path)
-            if md_content:
-                content += md_content + "\n"
-        elif source_type == "txt":
-            txt_path = input("Enter text file path: ").strip()
-            txt_content = read_txt(txt_path)
-            if txt_content:
-                content += txt_content + "\n"
+# Prompt for the path of each source type and the function reading it
+SOURCE_READERS = {
+    "pdf": ("Enter PDF file path: ", read_pdf),
+    "url": ("Enter URL: ", read_url),
+    "md": ("Enter Markdown file path: ", read_md),
+    "txt": ("Enter text file path: ", read_txt),
+}
+
+def read_source(source_type, source, cache=None):
+    """Reads one source, reusing the text extracted by an earlier run when a
+    cache is given and the source has not changed since"""
+    reader = SOURCE_READERS[source_type][1]
+    if cache is None:
+        return reader(source)
+    if source_type == "url":
+        return read_url(source, cache)
+
+    try:
+        key = ContentCache.file_key(source_type, source)
+    except OSError:
+        # Let the reader report the missing or unreadable file
+        return reader(source)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached[0]
+    text = reader(source)
+    if text:
+        cache.put(key, text)
+    return text
+
+def get_content_from_sources(cache=None, sources=None):
+    """Reads the given (type, path) sources, or those entered interactively
+    when there are none, and joins their text in order"""
+    # Sources are read in worker threads: all at once when given up front,
+    # otherwise each one while the next is being entered
+    with ThreadPoolExecutor(max_workers=SOURCE_WORKERS) as executor:
+        if sources:
+            futures = [executor.submit(read_source, source_type, path, cache) for source_type, path in sources]
         else:
-            print("Invalid source type. Please try again.")
-            
-    return content
+            futures = []
+            while True:
+                source_type = input("Enter source type (pdf/url/txt/md) or 'done' to finish: ").lower().strip()
+
+                if source_type == 'done':
+                    break
+
+                if source_type not in SOURCE_READERS:
+                    print("Invalid source type. Please try again.")
+                    continue
+
+                prompt = SOURCE_READERS[source_type][0]
+                futures.append(executor.submit(read_source, source_type, input(prompt).strip(), cache))
+
+        contents = [future.result() for future in futures]
 
+    return "".join(f"{source_content}\n" for source_content in contents if source_content)
+
+# The template is static for the life of the process
+@functools.lru_cache(maxsize=1)
 def load_prompt_template():
     try:
         with open('system_instructions_script_template.txt', 'r', encoding='utf-8') as file:
@@ -115,11 +289,15 @@ def load_prompt_template():
     except FileNotFoundError:
         raise FileNotFoundError("Prompt template file not found in system_instructions_script_template.txt")
 
+# Configured once and shared by every script generated in the process
+@functools.lru_cache(maxsize=1)
+def get_model():
+    genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
+    return genai.GenerativeModel(SCRIPT_MODEL)
+
 def create_podcast_script(content, language):
     try:
-        # Initialize Gemini
-        genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
-        model = genai.GenerativeModel('gemini-2.5-flash-preview-04-17')
+        model = get_model()
 
         # Load prompt template and format with content
         prompt_template = load_prompt_template()
@@ -131,35 +309,100 @@ def create_podcast_script(content, language):
         print(f"Error generating content: {str(e)}")
         return None
     
+def split_oversized(text, max_chars, level=0):
+    """Yields pieces of text of at most max_chars, each keeping its trailing
+    separator; a piece that is too long is cut at the next finer boundary in
+    SPLIT_BOUNDARIES, and at max_chars once none is left"""
+    if len(text) <= max_chars:
+        yield text
+    elif level == len(SPLIT_BOUNDARIES):
+        for start in range(0, len(text), max_chars):
+            yield text[start:start + max_chars]
+    else:
+        for piece in SPLIT_BOUNDARIES[level].split(text):
+            yield from split_oversized(piece, max_chars, level + 1)
+
+def split_content(content, max_chars):
+    """Splits content into parts of at most max_chars, cutting between
+    paragraphs where possible and then between lines or sentences, as PDF
+    and web text often has no blank lines at all"""
+    parts, current, size = [], [], 0
+    for piece in split_oversized(content, max_chars):
+        if current and size + len(piece) > max_chars:
+            parts.append("".join(current))
+            current, size = [], 0
+        current.append(piece)
+        size += len(piece)
+    if current:
+        parts.append("".join(current))
+    return parts
+
+def create_podcast_script_in_parts(content, language, max_chars):
+    """Generates the script of each part of a long content concurrently and
+    stitches the cleaned fragments together in order"""
+    parts = split_content(content, max_chars)
+    if len(parts) == 1:
+        return create_podcast_script(content, language)
+
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_PARTS) as executor:
+        scripts = list(executor.map(lambda part: create_podcast_script(part, language), parts))
+    if None in scripts:
+        return None
+    return "\n".join(clean_podcast_script(script).strip("\n") for script in scripts)
+
 def clean_podcast_script(script):
-    # Define a regex pattern to identify the start of the podcast text
-    podcast_start_pattern = r"^(Speaker A:|Speaker B:|Speaker C:)"
-    
-    # Split the script into lines
-    lines = script.splitlines()
-    
-    # Find the first line that matches the podcast start pattern
-    for i, line in enumerate(lines):
-        if re.match(podcast_start_pattern, line):
-            # Return the script starting from the first podcast line
-            return '\n'.join(lines[i:])
-    
+    # Find the first line that starts the podcast text and drop everything
+    # before it, in a single pass over the whole script
+    match = PODCAST_START_PATTERN.search(script)
+    if match:
+        return script[match.start():]
+
     # If no match is found, return the original script
     return script
 
-def parse_script_args():
+def parse_script_args(argv=None):
     parser = argparse.ArgumentParser(description="Generate script for podcast.")
     parser.add_argument('--language', default='English', help='Language for audio narration')
-    return parser.parse_args()
+    parser.add_argument('--source', nargs=2, action='append', metavar=('TYPE', 'PATH'),
+                        help='Source to read instead of prompting (pdf/url/txt/md); repeat for several')
+    parser.add_argument('--content-cache-dir', help='Directory to reuse extracted source text from across runs')
+    parser.add_argument('--script-cache-dir',
+                        help='Directory to reuse the generated script from when the content and language are unchanged')
+    parser.add_argument('--split-chars', type=int,
+                        help='Split content longer than this many characters and generate the parts concurrently')
+    args = parser.parse_args(argv)
+    args.source = [(source_type.lower(), path) for source_type, path in args.source or []]
+    for source_type, _ in args.source:
+        if source_type not in SOURCE_READERS:
+            parser.error(f"invalid source type: {source_type}")
+    return args
 
-def main():
-    script_args = parse_script_args()
+def main(argv=None):
+    script_args = parse_script_args(argv)
     # Get content from multiple sources
-    content = get_content_from_sources()
+    cache = ContentCache(script_args.content_cache_dir) if script_args.content_cache_dir else None
+    content = get_content_from_sources(cache, script_args.source)
     language = script_args.language
     
+    # Reuse the script of an earlier run on exactly the same input
+    script_cache = ContentCache(script_args.script_cache_dir) if script_args.script_cache_dir else None
+    if script_cache:
+        script_key = ContentCache.script_key(SCRIPT_MODEL, load_prompt_template(), language,
+                                             script_args.split_chars, content)
+        cached = script_cache.get(script_key)
+    else:
+        cached = None
+
     # Generate podcast script
-    script = create_podcast_script(content, language)
+    if cached:
+        print("Reusing the cached script for this content")
+        script = cached[0]
+    elif script_args.split_chars:
+        script = create_podcast_script_in_parts(content, language, script_args.split_chars)
+    else:
+        script = create_podcast_script(content, language)
+    if script_cache and script and not cached:
+        script_cache.put(script_key, script, language=language, model=SCRIPT_MODEL)
     if script:
         # Clean the script before saving
         cleaned_script = clean_podcast_script(script)
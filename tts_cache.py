@@ -0,0 +1,61 @@
+# tts_cache.py
+
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+class TtsCache:
+    """Content-addressed store of synthesized lines: one WAV per key plus a
+    JSON sidecar describing it, so an external pruner can expire entries"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(voice, language, dialogue, instructions):
+        instructions_sha = hashlib.sha256(instructions.encode('utf-8')).hexdigest()
+        return hashlib.sha256(f"{voice}|{language}|{dialogue}|{instructions_sha}".encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.wav")
+
+    def _write_atomic(self, path, fill):
+        """Calls fill with a unique temp file in the cache dir, then moves it
+        to path; a unique name per write, as a speaker repeating a line stores
+        the same key from two threads"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        os.close(fd)
+        try:
+            fill(tmp_path)
+            os.replace(tmp_path, path)
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+
+    def put(self, key, wav_file, voice=None, language=None):
+        """Copies wav_file into the cache under key; the entry and its sidecar
+        only become visible once fully written"""
+        self._write_atomic(self._path(key), lambda tmp_path: shutil.copyfile(wav_file, tmp_path))
+
+        sidecar = json.dumps({"created_at": time.time(), "voice": voice, "lang": language, "sha": key})
+
+        def write_sidecar(tmp_path):
+            with open(tmp_path, 'w', encoding='utf-8') as file:
+                file.write(sidecar)
+
+        self._write_atomic(os.path.join(self.cache_dir, f"{key}.json"), write_sidecar)
+
+    def fetch(self, key, output_file):
+        """Copies the cached WAV for key to output_file; returns False on a
+        miss, including an entry that cannot be read"""
+        try:
+            shutil.copyfile(self._path(key), output_file)
+        except OSError:
+            return False
+        return True